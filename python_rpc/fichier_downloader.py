@@ -1,209 +1,561 @@
 import os
 import re
+import sys
 import time
+import queue
+import logging
+import logging.handlers
 import random
-import tempfile
+import itertools
+import atexit
+import contextlib
 import requests
-import traceback
+import threading
 import concurrent.futures
-from urllib.parse import urlparse
+from collections import OrderedDict
+from urllib.parse import urlparse, unquote
+from requests.adapters import HTTPAdapter
 from http_downloader import HttpDownloader
 
+SUCCESS = 25
+logging.addLevelName(SUCCESS, "SUCCESS")
+
+# Circuit threads only push records onto an in-memory queue, a background listener
+# does the actual writing to stdout so they never block on it
+log = logging.getLogger("fichier")
+log.setLevel(logging.INFO)
+log.propagate = False
+_log_queue = queue.Queue()
+log.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_stream_handler = logging.StreamHandler(sys.stdout)
+_log_stream_handler.setFormatter(logging.Formatter("[FICHIER][%(levelname)s] %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
 try:
     from torpy.http.requests import TorRequests
     TORPY_AVAILABLE = True
 except ImportError:
     TORPY_AVAILABLE = False
-    print("Warning: torpy library not found. 1fichier downloads will not work properly.")
-    print("Please install torpy with: pip install torpy")
+    log.warning("torpy library not found. 1fichier downloads will not work properly.")
+    log.warning("Please install torpy with: pip install torpy")
+
+# Browser headers sent by every circuit, only the User-Agent changes per attempt
+_BASE_HEADERS = {
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8",
+    "Accept-Language": "en-US,en;q=0.5",
+    "Accept-Encoding": "gzip, deflate, br",
+    "Referer": "https://1fichier.com/",
+    "Connection": "keep-alive",
+    "Upgrade-Insecure-Requests": "1",
+    "Sec-Fetch-Dest": "document",
+    "Sec-Fetch-Mode": "navigate",
+    "Sec-Fetch-Site": "none",
+    "Sec-Fetch-User": "?1",
+    "Cache-Control": "max-age=0"
+}
+
+_USER_AGENTS = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:89.0) Gecko/20100101 Firefox/89.0",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.1.1 Safari/605.1.15",
+    "Mozilla/5.0 (Windows NT 10.0; rv:109.0) Gecko/20100101 Firefox/115.0"
+)
+
+# Matched against the raw response bytes, only the captured groups get decoded.
+# Each field keeps its own literal-prefixed pattern so re can skip ahead to the prefix instead of
+# trying every alternative at each offset, the filename cell is unrolled instead of ".*" so a page
+# without it can't make it backtrack across the whole body
+_RATE_LIMIT_RE = re.compile(rb'You must wait|Warning !|Attention !')
+_ADZ_RE = re.compile(rb'name="adz"\s+value="([^"]+)"')
+_FILENAME_RE = re.compile(rb'>Filename\s*:<[^<]*(?:<(?!td)[^<]*)*<td[^>]*class="normal"[^>]*>([^<]+)</td>')
+_WAIT_TIME_RE = re.compile(rb'You must wait ([0-9]+) minutes')
+_DL_LINK_RE = re.compile(rb'<a\s+href="(https?://[^"]+)"[^>]*>\s*Click here to download the file\s*</a>')
+
+# Fields looked for in the download page: name, the literals a match starts with and its pattern
+_PAGE_FIELDS = (
+    ('rate_limit', (b'You must wait', b'Warning !', b'Attention !'), _RATE_LIMIT_RE),
+    ('wait_time', (b'You must wait',), _WAIT_TIME_RE),
+    ('adz', (b'name="adz"',), _ADZ_RE),
+    ('filename', (b'>Filename',), _FILENAME_RE),
+    ('direct_url', (b'<a',), _DL_LINK_RE),
+)
+
+# aria2 reports the HTTP status of a failed request in its error message, e.g. "status=403"
+_ARIA2_HTTP_STATUS_RE = re.compile(r'status=([0-9]{3})')
+# Filename of a file response, plain or RFC 5987 encoded (filename*=UTF-8''...)
+_CONTENT_DISPOSITION_RE = re.compile(r'filename\*?=(?:[\w-]+\'[\w-]*\')?"?([^";]+)', re.IGNORECASE)
+
+class TokenBucket:
+    """Thread-safe token bucket used to pace the requests sent to a host"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate  # Tokens per second
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+        self.rng = random.Random()  # Own generator for the refill jitter, separate from the global one
+
+    def acquire(self, timeout=None):
+        """Take a token, waiting up to timeout seconds for one. Returns whether a token was taken"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                # Refill with up to 30% jitter so the waiting threads don't all fire in lockstep
+                refill = (now - self.updated_at) * self.rate * self.rng.uniform(0.7, 1.0)
+                self.tokens = min(self.burst, self.tokens + refill)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait_time = (1 - self.tokens) / self.rate
+
+            if deadline is not None:
+                remaining_time = deadline - time.monotonic()
+                if remaining_time <= 0:
+                    return False
+                wait_time = min(wait_time, remaining_time)
+            time.sleep(wait_time)
 
 class FichierDownloader:
+    # (timestamp, result) do último teste de disponibilidade, compartilhado entre instâncias
+    _service_check_cache = (0.0, False)
+    _service_check_ttl = 60  # Segundos
+    # url -> (timestamp, direct_url, filename, user_agent) dos links diretos obtidos recentemente
+    _link_cache = OrderedDict()
+    _link_cache_ttl = 180  # Segundos
+    _link_cache_size = 32
+    _link_cache_lock = threading.Lock()
+    # Limitador de requisições por host, compartilhado entre todos os downloads
+    _host_buckets = {}
+    _host_buckets_lock = threading.Lock()
+
     def __init__(self):
         self.http_downloader = HttpDownloader()
+        self.rng = random.Random()  # Gerador próprio para User-Agents e jitter, separado do global
         self.current_url = None
         self.save_path = None
         self.filename = None
         self.direct_url = None
         self.max_attempts = 10
         self.max_parallel_attempts = 5  # Número de circuitos Tor paralelos
-        self.circuit_timeout = 30  # Timeout para cada tentativa de circuito em segundos
+        self.max_rate_limit_wait = 300  # Espera máxima pedida pelo 1fichier (segundos) antes de desistir
+        self.circuit_timeout = (10, 20)  # Timeouts (conexão, leitura) de cada requisição do circuito em segundos
+        self.max_page_size = 128 * 1024  # Limite de bytes lidos de cada página do 1fichier
+        self.batch_timeout = 90  # Tempo máximo de espera por um lote de circuitos em segundos
+        # Pool de threads reaproveitado entre lotes e downloads, criado sob demanda
+        self.circuit_executor = None
+        # Circuitos Tor mantidos abertos por thread do pool, reaproveitados entre tentativas
+        self.circuit_local = threading.local()
+        self.open_circuits = set()
+        self.open_circuits_lock = threading.Lock()
+        # Circuito Tor que obteve o link direto, usado caso o aria2 não consiga baixar fora do Tor
+        self.active_tor_circuit = None
+        self.active_tor_session = None
+        self.tor_download_status = None
+        self.tor_download_stop = threading.Event()  # Evento de parada do download via Tor atual, um novo para cada thread
+        self.tor_download_lock = threading.Lock()  # Impede que duas threads escrevam o mesmo arquivo ao mesmo tempo
+        self.link_found = threading.Event()  # Sinaliza aos circuitos pendentes que um link já foi obtido
+        self.lookup_running = False  # Indica se uma busca de link direto está em andamento
+        # Sessão HTTP persistente para as requisições fora do Tor, evita um novo handshake TLS a cada teste
+        self.probe_session = requests.Session()
+        self.probe_session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=2, max_retries=0))
+        self.probe_session.headers.update(_BASE_HEADERS)
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """Shut down the circuit thread pool, the probe session and the open Tor circuits
+
+        The downloader can still be restarted afterwards, the thread pool is recreated when needed
+        """
+        if self.circuit_executor is not None:
+            self.circuit_executor.shutdown(wait=False, cancel_futures=True)
+            self.circuit_executor = None
+        # Only drops the pooled connections, the session can still be used if the download is restarted
+        self.probe_session.close()
+        self.active_tor_circuit = None
+        self.active_tor_session = None
+        with self.open_circuits_lock:
+            open_circuits = list(self.open_circuits)
+        for circuit in open_circuits:
+            self._close_tor_circuit(circuit)
+
+    def _get_circuit_executor(self):
+        """Return the circuit thread pool, creating it if it was never created or has been shut down"""
+        if self.circuit_executor is None:
+            self.circuit_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_parallel_attempts, thread_name_prefix="fichier-circuit")
+        return self.circuit_executor
 
     def _get_random_user_agent(self):
         """Return a random user agent to avoid detection"""
-        user_agents = [
-            "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-            "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:89.0) Gecko/20100101 Firefox/89.0",
-            "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.1.1 Safari/605.1.15",
-            "Mozilla/5.0 (Windows NT 10.0; rv:109.0) Gecko/20100101 Firefox/115.0"
-        ]
-        return random.choice(user_agents)
+        return self.rng.choice(_USER_AGENTS)
 
     def _check_tor_available(self):
         """Check if Tor is available"""
         if not TORPY_AVAILABLE:
-            print("[FICHIER][ERROR] torpy library is not available. 1fichier downloads will not work.")
-            print("[FICHIER][ERROR] Please install torpy with: pip install torpy")
+            log.error("torpy library is not available. 1fichier downloads will not work.")
+            log.error("Please install torpy with: pip install torpy")
             raise Exception("torpy library is required for 1fichier downloads")
 
     def _check_service_availability(self):
+        """Check if 1fichier service is available, reusing a recent result if there is one"""
+        now = time.time()
+        checked_at, available = FichierDownloader._service_check_cache
+        if now - checked_at < self._service_check_ttl:
+            log.debug("Using cached 1fichier availability result: %s", available)
+            return available
+
+        available = self._probe_service_availability()
+        FichierDownloader._service_check_cache = (now, available)
+        return available
+
+    def _probe_service_availability(self):
         """Check if 1fichier service is available before attempting downloads"""
         try:
-            print("[FICHIER][INFO] Checking 1fichier service availability...")
+            log.info("Checking 1fichier service availability...")
             # Use a direct request without Tor to check service availability
             headers = {"User-Agent": self._get_random_user_agent()}
-            response = requests.get("https://1fichier.com", headers=headers, timeout=10)
+            response = self.probe_session.head("https://1fichier.com", headers=headers, timeout=3, allow_redirects=True)
 
             if response.status_code == 200:
-                print("[FICHIER][INFO] 1fichier service is available and responding normally")
+                log.info("1fichier service is available and responding normally")
                 return True
             else:
-                print(f"[FICHIER][WARNING] 1fichier service returned unexpected status code: {response.status_code}")
+                log.warning(f"1fichier service returned unexpected status code: {response.status_code}")
                 return False
         except requests.exceptions.ConnectionError as e:
-            print(f"[FICHIER][ERROR] Connection error checking 1fichier service: {str(e)}")
+            log.error(f"Connection error checking 1fichier service: {str(e)}")
             return False
         except requests.exceptions.Timeout as e:
-            print(f"[FICHIER][ERROR] Timeout checking 1fichier service: {str(e)}")
+            log.error(f"Timeout checking 1fichier service: {str(e)}")
             return False
         except Exception as e:
-            print(f"[FICHIER][ERROR] Unexpected error checking 1fichier service: {str(e)}")
-            traceback.print_exc()
+            log.exception(f"Unexpected error checking 1fichier service: {str(e)}")
             return False
 
     def _extract_filename_from_url(self, url):
         """Extract filename from URL if possible"""
-        parsed_url = urlparse(url)
-        path_parts = parsed_url.path.split('/')
-        if len(path_parts) > 0:
-            filename = path_parts[-1]
-            if not filename:
-                filename = "download"
-        else:
-            filename = "download"
-        return filename
+        filename = urlparse(url).path.rpartition('/')[2]
+        return filename or "download"
+
+    def _extract_filename_from_response(self, response):
+        """Extract filename from the Content-Disposition header, or from the final URL"""
+        disposition_match = _CONTENT_DISPOSITION_RE.search(response.headers.get('Content-Disposition', ''))
+        if disposition_match:
+            return unquote(disposition_match.group(1).strip())
+        return self._extract_filename_from_url(response.url)
+
+    def _read_page(self, response, need_filename):
+        """Read a streamed page only until the rate limit warning or the download form shows up
+
+        Returns the page and the fields found in it ('rate_limit', 'wait_time', 'adz', 'filename' and 'direct_url')
+        """
+        page = bytearray()
+        fields = {}
+        rate_limit_seen_at = None  # Page size when the rate limit warning first showed up
+        # Where the next search for each missing field starts: the last label that hasn't
+        # completed yet, so a match split across chunks is still found when the rest arrives
+        scan_from = dict.fromkeys((name for name, _, _ in _PAGE_FIELDS), 0)
+        try:
+            for chunk in response.iter_content(chunk_size=8192):
+                page += chunk
+                for name, labels, pattern in _PAGE_FIELDS:
+                    if name in fields or (name == 'filename' and not need_filename):
+                        continue
+                    match = pattern.search(page, scan_from[name])
+                    if match:
+                        fields[name] = match.group(match.lastindex or 0)
+                        continue
+                    label_start = max(page.rfind(label, scan_from[name]) for label in labels)
+                    if label_start >= 0:
+                        scan_from[name] = label_start
+                    else:
+                        # Keep just enough of the tail for a label cut in half by the chunk boundary
+                        scan_from[name] = max(scan_from[name], len(page) - max(map(len, labels)) + 1)
+
+                # The wait time may come after another warning or in the next chunk, read a
+                # little further for it so the back-off can honor it
+                if 'rate_limit' in fields:
+                    if rate_limit_seen_at is None:
+                        rate_limit_seen_at = len(page)
+                    if 'wait_time' in fields or len(page) - rate_limit_seen_at >= 8192:
+                        break
+                if 'direct_url' in fields:
+                    break
+                if 'adz' in fields and (not need_filename or 'filename' in fields):
+                    break
+                if len(page) >= self.max_page_size:
+                    break
+        finally:
+            response.close()
+        return bytes(page), fields
+
+    def _read_body(self, response):
+        """Read a streamed response body, up to max_page_size bytes"""
+        body = bytearray()
+        try:
+            for chunk in response.iter_content(chunk_size=8192):
+                body += chunk
+                if len(body) >= self.max_page_size:
+                    break
+        finally:
+            response.close()
+        return bytes(body)
+
+    def _extract_direct_url(self, response):
+        """Get the direct link from the form response, checking the redirect before reading the body
+
+        Returns the direct link, or None, and the body that was read
+        """
+        location = response.headers.get('Location')
+        if response.status_code in (302, 303) and location:
+            response.close()
+            return location, b""
+
+        # A plain substring check is much cheaper than the regex on pages without the link
+        body = self._read_body(response)
+        if b"Click here to download the file" not in body:
+            return None, body
+
+        download_link_match = _DL_LINK_RE.search(body)
+        return (download_link_match.group(1).decode() if download_link_match else None), body
+
+    def _get_tor_session(self):
+        """Return the current worker thread's Tor session, building a new circuit if it has none"""
+        session = getattr(self.circuit_local, 'session', None)
+        # The circuit may have been released since this thread last used it
+        with self.open_circuits_lock:
+            circuit_open = getattr(self.circuit_local, 'circuit', None) in self.open_circuits
+        if session is None or not circuit_open:
+            circuit = contextlib.ExitStack()
+            try:
+                tor_requests = circuit.enter_context(TorRequests())
+                session = circuit.enter_context(tor_requests.get_session())
+            except BaseException:
+                circuit.close()
+                raise
+
+            with self.open_circuits_lock:
+                self.open_circuits.add(circuit)
+            self.circuit_local.circuit = circuit
+            self.circuit_local.session = session
+        return session
+
+    def _drop_tor_session(self):
+        """Close the current worker thread's Tor circuit so the next attempt builds a new one"""
+        circuit = getattr(self.circuit_local, 'circuit', None)
+        self.circuit_local.circuit = None
+        self.circuit_local.session = None
+        if circuit is not None:
+            self._close_tor_circuit(circuit)
+
+    def _detach_tor_session(self):
+        """Hand the current worker thread's Tor circuit over to the caller, the thread builds a new one next time"""
+        circuit = getattr(self.circuit_local, 'circuit', None)
+        session = getattr(self.circuit_local, 'session', None)
+        self.circuit_local.circuit = None
+        self.circuit_local.session = None
+        return circuit, session
+
+    def _set_active_tor_session(self, circuit, session):
+        """Keep the Tor circuit that obtained the direct link, closing the previous one"""
+        previous_circuit = self.active_tor_circuit
+        self.active_tor_circuit = circuit
+        self.active_tor_session = session
+        if previous_circuit is not None and previous_circuit is not circuit:
+            self._close_tor_circuit(previous_circuit)
+
+    def _close_tor_circuit(self, circuit):
+        """Close a Tor circuit and stop tracking it"""
+        with self.open_circuits_lock:
+            self.open_circuits.discard(circuit)
+        try:
+            circuit.close()
+        except Exception as e:
+            log.warning(f"Error closing Tor circuit: {str(e)}")
+
+    def _release_idle_circuits(self):
+        """Close every open Tor circuit except the one kept for the download"""
+        with self.open_circuits_lock:
+            idle_circuits = [circuit for circuit in self.open_circuits if circuit is not self.active_tor_circuit]
+        for circuit in idle_circuits:
+            self._close_tor_circuit(circuit)
+
+    def _close_ignored_result(self, future):
+        """Close the Tor circuit kept by a circuit attempt that finished after its result stopped mattering"""
+        if future.cancelled() or future.exception() is not None:
+            return
+        result = future.result()
+        if result and result.get('tor_circuit') is not None and result['tor_circuit'] is not self.active_tor_circuit:
+            self._close_tor_circuit(result['tor_circuit'])
+
+    def _direct_link_result(self, attempt_id, direct_url, filename, user_agent, start_time):
+        """Build the result of a circuit that obtained the direct link"""
+        elapsed = time.time() - start_time
+        log.log(SUCCESS, f"Circuit {attempt_id}: Successfully obtained direct link in {elapsed:.2f}s")
+        log.info(f"Circuit {attempt_id}: Direct URL: {direct_url[:50]}...")
+        # The direct link may be tied to this exit node, keep the circuit for the download
+        tor_circuit, tor_session = self._detach_tor_session()
+        return {
+            'success': True,
+            'direct_url': direct_url,
+            'filename': filename,
+            'user_agent': user_agent,
+            'tor_circuit': tor_circuit,
+            'tor_session': tor_session
+        }
+
+    def _get_host_bucket(self, url):
+        """Return the token bucket shared by every request to the url's host"""
+        host = urlparse(url).hostname
+        with FichierDownloader._host_buckets_lock:
+            bucket = FichierDownloader._host_buckets.get(host)
+            if bucket is None:
+                bucket = TokenBucket(rate=1.0, burst=3)
+                FichierDownloader._host_buckets[host] = bucket
+            return bucket
 
     def _try_single_circuit(self, url, attempt_id):
         """Try to get direct link using a single Tor circuit"""
         try:
-            print(f"[FICHIER][INFO] Circuit attempt {attempt_id} started")
+            log.info(f"Circuit attempt {attempt_id} started")
 
             # Set headers to mimic a browser
             user_agent = self._get_random_user_agent()
-            print(f"[FICHIER][DEBUG] Circuit {attempt_id} using User-Agent: {user_agent}")
-
-            headers = {
-                "User-Agent": user_agent,
-                "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8",
-                "Accept-Language": "en-US,en;q=0.5",
-                "Accept-Encoding": "gzip, deflate, br",
-                "Referer": "https://1fichier.com/",
-                "Connection": "keep-alive",
-                "Upgrade-Insecure-Requests": "1",
-                "Sec-Fetch-Dest": "document",
-                "Sec-Fetch-Mode": "navigate",
-                "Sec-Fetch-Site": "none",
-                "Sec-Fetch-User": "?1",
-                "Cache-Control": "max-age=0"
-            }
+            log.debug("Circuit %d using User-Agent: %s", attempt_id, user_agent)
+
+            headers = _BASE_HEADERS.copy()
+            headers["User-Agent"] = user_agent
 
-            # Create a new TorRequests instance for this attempt with retry mechanism
+            # Each worker thread keeps its Tor circuit open across retries and attempts, a new
+            # one is only built after a circuit-level failure or when 1fichier rate limits it
             max_tor_retries = 3
             for tor_retry in range(max_tor_retries):
+                if self.link_found.is_set():
+                    log.debug("Circuit %d: Direct link already obtained by another circuit, stopping", attempt_id)
+                    break
+
                 try:
-                    # Create a new TorRequests instance for each retry
-                    with TorRequests() as tor_requests:
-                        # Get a new Tor circuit with timeout
-                        with tor_requests.get_session() as session:
-                            # Get the download page
-                            start_time = time.time()
-                            response = session.get(url, headers=headers, timeout=self.circuit_timeout)
-
-                            # Check if we're being rate limited or need to wait
-                            if "You must wait" in response.text or "Warning !" in response.text or "Attention !" in response.text:
-                                print(f"[FICHIER][WARNING] Circuit {attempt_id}: Rate limit detected, 1fichier is blocking this request")
-                                # Try to extract the wait time if available
-                                wait_match = re.search(r'You must wait ([0-9]+) minutes', response.text)
-                                if wait_match:
-                                    wait_time = wait_match.group(1)
-                                    print(f"[FICHIER][INFO] Circuit {attempt_id}: Wait time specified: {wait_time} minutes")
-                                break  # No need to retry this circuit
-
-                            # Try to extract the filename if not already set
-                            local_filename = self.filename
-                            if local_filename == "download":
-                                filename_match = re.search(r'>Filename :<.*<td class="normal">(.*)</td>', response.text)
-                                if filename_match:
-                                    local_filename = filename_match.group(1)
-                                    print(f"[FICHIER][INFO] Circuit {attempt_id}: Extracted filename: {local_filename}")
-                                else:
-                                    print(f"[FICHIER][WARNING] Circuit {attempt_id}: Could not extract filename from page")
-
-                            # Check if we can find the download form
-                            adz_match = re.search(r'name="adz" value="([^"]+)"', response.text)
-                            if not adz_match:
-                                print(f"[FICHIER][WARNING] Circuit {attempt_id}: No download form found in the page")
-                                # Check for common error messages
-                                if "file could not be found" in response.text or "file has been deleted" in response.text:
-                                    print(f"[FICHIER][ERROR] Circuit {attempt_id}: File not found or has been deleted")
-                                elif "file is password protected" in response.text:
-                                    print(f"[FICHIER][ERROR] Circuit {attempt_id}: File is password protected, cannot proceed")
-                                break  # No need to retry this circuit
-
-                            adz_value = adz_match.group(1)
-                            print(f"[FICHIER][INFO] Circuit {attempt_id}: Found download form, submitting request...")
-
-                            # Submit the download form
-                            form_data = {"submit": "Download", "adz": adz_value}
-                            print(f"[FICHIER][DEBUG] Circuit {attempt_id}: Submitting form with adz value: {adz_value[:10]}...")
-                            download_response = session.post(url, data=form_data, headers=headers, allow_redirects=False, timeout=self.circuit_timeout)
-                            print(f"[FICHIER][DEBUG] Circuit {attempt_id}: Form submission response status: {download_response.status_code}")
-
-                            # Check for redirect which contains the direct download link
-                            if download_response.status_code in (302, 303) and 'Location' in download_response.headers:
-                                direct_url = download_response.headers['Location']
-                                elapsed = time.time() - start_time
-                                print(f"[FICHIER][SUCCESS] Circuit {attempt_id}: Successfully obtained direct link via redirect in {elapsed:.2f}s")
-                                print(f"[FICHIER][INFO] Circuit {attempt_id}: Direct URL: {direct_url[:50]}...")
-                                return {
-                                    'success': True,
-                                    'direct_url': direct_url,
-                                    'filename': local_filename,
-                                    'user_agent': user_agent
-                                }
-
-                            # If no redirect, try to find the download link in the response
-                            download_link_match = re.search(r'<a href="(https?://[^"]+)"[^>]*>Click here to download the file</a>', download_response.text)
-                            if download_link_match:
-                                direct_url = download_link_match.group(1)
-                                elapsed = time.time() - start_time
-                                print(f"[FICHIER][SUCCESS] Circuit {attempt_id}: Successfully extracted direct link from content in {elapsed:.2f}s")
-                                print(f"[FICHIER][INFO] Circuit {attempt_id}: Direct URL: {direct_url[:50]}...")
-                                return {
-                                    'success': True,
-                                    'direct_url': direct_url,
-                                    'filename': local_filename,
-                                    'user_agent': user_agent
-                                }
-
-                            print(f"[FICHIER][ERROR] Circuit {attempt_id}: Failed to extract download link from response")
-                            # Try to find error messages in the response
-                            if "limit" in download_response.text.lower() or "wait" in download_response.text.lower():
-                                print(f"[FICHIER][WARNING] Circuit {attempt_id}: Possible rate limit in response")
-                            break  # No need to retry this circuit if we got a response but no link
+                    session = self._get_tor_session()
+
+                    # Pace the page requests of all circuits. When no request slot frees up in time the
+                    # attempt fails instead of sending the request anyway, so the limit actually holds
+                    if not self._get_host_bucket(url).acquire(timeout=5):
+                        log.warning(f"Circuit {attempt_id}: Host request budget exhausted, giving up this attempt")
+                        break
+
+                    # Get the download page, streamed so we can stop reading once we have what we need
+                    start_time = time.time()
+                    response = session.get(url, headers=headers, timeout=self.circuit_timeout, stream=True)
+
+                    # Transient server errors can be retried on the same circuit
+                    if response.status_code >= 500 and tor_retry < max_tor_retries - 1:
+                        log.warning(f"Circuit {attempt_id}: Server error {response.status_code} (retry {tor_retry+1}/{max_tor_retries}), retrying on the same circuit")
+                        response.close()
+                        time.sleep(self.rng.uniform(0, 0.5 * (2 ** tor_retry)))
+                        continue
+
+                    # Some pages redirect straight to the file, there's no form to submit then.
+                    # A redirect to an error page isn't the file, whatever its content type
+                    if response.history and response.ok and not response.headers.get('Content-Type', '').startswith('text/html'):
+                        response.close()
+                        log.info(f"Circuit {attempt_id}: Download page redirected straight to the file")
+                        # There's no page to read the filename from, take it from the file response
+                        local_filename = self.filename
+                        if local_filename == "download":
+                            local_filename = self._extract_filename_from_response(response)
+                            log.info(f"Circuit {attempt_id}: Extracted filename: {local_filename}")
+                        return self._direct_link_result(attempt_id, response.url, local_filename, user_agent, start_time)
+
+                    page, page_fields = self._read_page(response, self.filename == "download")
+
+                    # Check if we're being rate limited or need to wait
+                    if 'rate_limit' in page_fields:
+                        log.warning(f"Circuit {attempt_id}: Rate limit detected, 1fichier is blocking this request")
+                        # Try to extract the wait time if available
+                        retry_after = None
+                        if 'wait_time' in page_fields:
+                            wait_time = int(page_fields['wait_time'])
+                            retry_after = wait_time * 60
+                            log.info(f"Circuit {attempt_id}: Wait time specified: {wait_time} minutes")
+                        # This exit node is rate limited, rotate to a new circuit for the next attempt
+                        self._drop_tor_session()
+                        return {
+                            'success': False,
+                            'rate_limited': True,
+                            'retry_after': retry_after
+                        }
+
+                    # Try to extract the filename if not already set
+                    local_filename = self.filename
+                    if local_filename == "download":
+                        if 'filename' in page_fields:
+                            local_filename = page_fields['filename'].decode("utf-8", errors="replace")
+                            log.info(f"Circuit {attempt_id}: Extracted filename: {local_filename}")
+                        else:
+                            log.warning(f"Circuit {attempt_id}: Could not extract filename from page")
+
+                    # Some pages already have the download link, skip the form round-trip
+                    if 'direct_url' in page_fields:
+                        log.info(f"Circuit {attempt_id}: Download link found in the page, skipping the form")
+                        return self._direct_link_result(attempt_id, page_fields['direct_url'].decode(), local_filename, user_agent, start_time)
+
+                    # Check if we can find the download form
+                    if 'adz' not in page_fields:
+                        log.warning(f"Circuit {attempt_id}: No download form found in the page")
+                        # Check for common error messages
+                        if b"file could not be found" in page or b"file has been deleted" in page:
+                            log.error(f"Circuit {attempt_id}: File not found or has been deleted")
+                        elif b"file is password protected" in page:
+                            log.error(f"Circuit {attempt_id}: File is password protected, cannot proceed")
+                        break  # No need to retry this circuit
+
+                    # Another circuit may have succeeded while this one was waiting on the page
+                    if self.link_found.is_set():
+                        log.debug("Circuit %d: Direct link already obtained by another circuit, stopping", attempt_id)
+                        break
+
+                    adz_value = page_fields['adz'].decode()
+                    log.info(f"Circuit {attempt_id}: Found download form, submitting request...")
+
+                    # Submit the download form
+                    form_data = {"submit": "Download", "adz": adz_value}
+                    log.debug("Circuit %d: Submitting form with adz value: %s...", attempt_id, adz_value[:10])
+                    # Streamed so the body never travels over Tor when we get a redirect
+                    download_response = session.post(url, data=form_data, headers=headers, allow_redirects=False, timeout=self.circuit_timeout, stream=True)
+                    log.debug("Circuit %d: Form submission response status: %d", attempt_id, download_response.status_code)
+
+                    direct_url, response_body = self._extract_direct_url(download_response)
+                    if direct_url:
+                        return self._direct_link_result(attempt_id, direct_url, local_filename, user_agent, start_time)
+
+                    log.error(f"Circuit {attempt_id}: Failed to extract download link from response")
+                    # Try to find error messages in the response
+                    response_body = response_body.lower()
+                    if b"limit" in response_body or b"wait" in response_body:
+                        log.warning(f"Circuit {attempt_id}: Possible rate limit in response")
+                    break  # No need to retry this circuit if we got a response but no link
 
                 except (AssertionError, ConnectionError, TimeoutError) as circuit_error:
-                    # These are common Tor circuit errors that can be retried
+                    # These are common Tor circuit errors, drop the circuit so the next retry builds a new one
+                    self._drop_tor_session()
                     if tor_retry < max_tor_retries - 1:
-                        print(f"[FICHIER][WARNING] Circuit {attempt_id}: Tor circuit error (retry {tor_retry+1}/{max_tor_retries}): {str(circuit_error)}")
-                        time.sleep(0.5)  # Short delay before retry
+                        log.warning(f"Circuit {attempt_id}: Tor circuit error (retry {tor_retry+1}/{max_tor_retries}): {str(circuit_error)}")
+                        time.sleep(self.rng.uniform(0, 0.5 * (2 ** tor_retry)))  # Short jittered delay before retry
                         continue
                     else:
-                        print(f"[FICHIER][ERROR] Circuit {attempt_id}: Max Tor retries reached, giving up on this circuit")
-                        print(f"[FICHIER][DEBUG] Circuit {attempt_id}: Last error: {str(circuit_error)}")
+                        log.error(f"Circuit {attempt_id}: Max Tor retries reached, giving up on this circuit")
+                        log.debug("Circuit %d: Last error: %s", attempt_id, circuit_error)
                         break
                 except Exception as other_error:
-                    print(f"[FICHIER][ERROR] Circuit {attempt_id}: Unexpected error in Tor circuit: {str(other_error)}")
-                    traceback.print_exc()
+                    # Not one of the expected Tor failures, keep the traceback
+                    log.exception(f"Circuit {attempt_id}: Unexpected error in Tor circuit: {str(other_error)}")
+                    self._drop_tor_session()
                     break
 
                 # If we got here without exceptions, no need to retry
@@ -212,162 +564,265 @@ class FichierDownloader:
             return None  # Return None if all retries failed or no link was found
 
         except Exception as e:
-            print(f"[FICHIER][ERROR] Circuit {attempt_id}: Error in circuit attempt: {str(e)}")
-            traceback.print_exc()
+            log.exception(f"Circuit {attempt_id}: Error in circuit attempt: {str(e)}")
             return None
+        finally:
+            # The lookup ended while this attempt was running, its circuit won't be reused
+            if not self.lookup_running:
+                self._drop_tor_session()
+
+    def _run_circuit_attempt(self, url, attempt_id, started_at):
+        """Record when a queued circuit attempt gets a thread, then run it"""
+        started_at[attempt_id] = time.monotonic()
+        return self._try_single_circuit(url, attempt_id)
+
+    def _cache_direct_link(self, url, direct_url):
+        """Remember a direct link, evicting the least recently used entry once the cache is full"""
+        link_cache = FichierDownloader._link_cache
+        with FichierDownloader._link_cache_lock:
+            link_cache[url] = (time.monotonic(), direct_url, self.filename, self.session_user_agent)
+            link_cache.move_to_end(url)
+            while len(link_cache) > self._link_cache_size:
+                link_cache.popitem(last=False)
 
     def _get_direct_link(self, url):
         """Get the direct download link from 1fichier using parallel circuits"""
-        print(f"[FICHIER][INFO] Starting process to get direct download link from: {url}")
+        log.info(f"Starting process to get direct download link from: {url}")
+
+        # Direct links stay valid for a while, reuse a recent one instead of going through Tor again
+        with FichierDownloader._link_cache_lock:
+            cached_at, direct_url, filename, user_agent = self._link_cache.get(url, (0.0, None, None, None))
+            cache_age = time.monotonic() - cached_at
+            cache_hit = direct_url and cache_age < self._link_cache_ttl
+            if cache_hit:
+                self._link_cache.move_to_end(url)
+        if cache_hit:
+            log.info(f"Reusing direct link obtained {cache_age:.0f}s ago")
+            self.filename = filename
+            self.session_user_agent = user_agent
+            return direct_url
+
         self._check_tor_available()
 
-        # Check if 1fichier service is available before attempting
-        if not self._check_service_availability():
-            print("[FICHIER][WARNING] 1fichier service may be unavailable, but will try anyway")
+        # Check if 1fichier service is available in the background, the result only
+        # informs the logs so it shouldn't delay the first batch of circuits
+        probe_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        service_probe = probe_executor.submit(self._check_service_availability)
+        probe_executor.shutdown(wait=False)
+
+        self.link_found.clear()
 
         # Extract filename from URL if possible
         self.filename = self._extract_filename_from_url(url)
-        print(f"[FICHIER][INFO] Attempting to download file: {self.filename}")
-        print(f"[FICHIER][INFO] Using Tor to bypass 1fichier download restrictions")
-
-        # Track total attempts and successful/failed circuits
-        total_attempts = 0
-        successful_circuits = 0
-        failed_circuits = 0
-        batch_delay = 1  # Initial delay between batches (seconds)
-        max_batch_delay = 5  # Maximum delay between batches
-        start_time = time.time()
+        log.info(f"Attempting to download file: {self.filename}")
+        log.info("Using Tor to bypass 1fichier download restrictions")
 
-        print(f"[FICHIER][INFO] Will attempt up to {self.max_attempts} Tor circuits with {self.max_parallel_attempts} parallel attempts per batch")
+        # Circuits built by this lookup are released once it ends, except the one kept for the download
+        self.lookup_running = True
+        try:
+            # Track total attempts and failed circuits
+            total_attempts = 0
+            failed_circuits = 0
+            start_time = time.time()
 
-        # Try sequential batches of parallel attempts
-        for batch in range((self.max_attempts // self.max_parallel_attempts) + 1):
-            # Check if we've exceeded max attempts
-            if total_attempts >= self.max_attempts:
-                break
+            log.info(f"Will attempt up to {self.max_attempts} Tor circuits with {self.max_parallel_attempts} parallel attempts per batch")
 
-            batch_start_time = time.time()
-            print(f"[FICHIER][INFO] Starting batch {batch+1} of parallel circuit attempts")
+            # Try sequential batches of parallel attempts, until max_attempts circuits have actually run
+            for batch in itertools.count():
+                # Check if we've exceeded max attempts
+                if total_attempts >= self.max_attempts:
+                    break
 
-            # Calculate how many attempts to make in this batch
-            remaining_attempts = self.max_attempts - total_attempts
-            batch_size = min(self.max_parallel_attempts, remaining_attempts)
+                batch_start_time = time.time()
+                log.info(f"Starting batch {batch+1} of parallel circuit attempts")
 
-            if batch_size <= 0:
-                print(f"[FICHIER][INFO] No more attempts remaining, stopping")
-                break
+                # Calculate how many attempts to make in this batch
+                remaining_attempts = self.max_attempts - total_attempts
+                batch_size = min(self.max_parallel_attempts, remaining_attempts)
+
+                if batch_size <= 0:
+                    log.info("No more attempts remaining, stopping")
+                    break
 
-            print(f"[FICHIER][INFO] Batch {batch+1} will use {batch_size} parallel Tor circuits")
+                log.info(f"Batch {batch+1} will use {batch_size} parallel Tor circuits")
 
-            # Create a thread pool for parallel attempts
-            with concurrent.futures.ThreadPoolExecutor(max_workers=batch_size) as executor:
-                # Submit parallel circuit attempts
+                # Submit parallel circuit attempts, they may sit in the queue while circuits
+                # left running by an earlier batch still hold the pool's threads
                 future_to_circuit = {}
+                started_at = {}
+                submitted_at = time.monotonic()
                 for i in range(batch_size):
                     attempt_id = total_attempts + i + 1
-                    future = executor.submit(self._try_single_circuit, url, attempt_id)
+                    future = self._get_circuit_executor().submit(self._run_circuit_attempt, url, attempt_id, started_at)
                     future_to_circuit[future] = attempt_id
 
                 # Update total attempts
                 total_attempts += batch_size
-                batch_results = 0
-
-                # Process results as they complete
-                for future in concurrent.futures.as_completed(future_to_circuit):
-                    circuit_id = future_to_circuit[future]
-                    try:
-                        result = future.result()
-                        if result:
-                            # Update filename if found
-                            if result['filename'] != "download":
-                                self.filename = result['filename']
-
-                            # Store the user agent from the successful circuit
-                            self.session_user_agent = result.get('user_agent')
-                            if self.session_user_agent:
-                                print(f"[FICHIER][INFO] Storing successful User-Agent for download: {self.session_user_agent[:30]}...")
-
-                            elapsed = time.time() - start_time
-                            print(f"[FICHIER][SUCCESS] Successfully found direct link after {total_attempts} total attempts ({elapsed:.2f}s)")
-                            print(f"[FICHIER][INFO] Direct URL obtained, ready for download")
-                            return result['direct_url']
-                        else:
+
+                # Shortest wait asked by 1fichier among the rate limited circuits of this batch, and how
+                # many circuits were asked to wait longer than we are willing to
+                retry_after = None
+                blocked_circuits = 0
+
+                # Wait for the circuits as they complete, once one succeeds the rest are
+                # cancelled without unwrapping their results or logging their late failures.
+                # Each circuit gets batch_timeout seconds from when it actually started running,
+                # or from submission while it is still queued
+                pending = set(future_to_circuit)
+                while pending:
+                    deadlines = [started_at.get(future_to_circuit[future], submitted_at) + self.batch_timeout for future in pending]
+                    remaining_time = max(deadlines) - time.monotonic()
+                    if remaining_time <= 0:
+                        # Don't let stuck circuits hold the batch, they will exit on their own timeouts.
+                        # Circuits that never got a thread aren't attempts, they are just dropped
+                        never_started = sum(1 for future in pending if future.cancel())
+                        total_attempts -= never_started
+                        failed_circuits += len(pending) - never_started
+                        log.warning(f"{len(pending) - never_started} circuits still running and {never_started} never started after {self.batch_timeout}s, moving on")
+                        for pending_future in pending:
+                            pending_future.add_done_callback(self._close_ignored_result)
+                        # The stuck circuits keep their threads until they exit, give the next batch a
+                        # fresh pool instead of queueing it behind them
+                        if self.circuit_executor is not None:
+                            self.circuit_executor.shutdown(wait=False)
+                            self.circuit_executor = None
+                        break
+
+                    done, pending = concurrent.futures.wait(pending, timeout=remaining_time, return_when=concurrent.futures.FIRST_COMPLETED)
+
+                    for future in done:
+                        circuit_id = future_to_circuit[future]
+                        try:
+                            result = future.result()
+                            if result and result['success']:
+                                # Update filename if found
+                                if result['filename'] != "download":
+                                    self.filename = result['filename']
+
+                                self._set_active_tor_session(result['tor_circuit'], result['tor_session'])
+
+                                # Store the user agent from the successful circuit
+                                self.session_user_agent = result.get('user_agent')
+                                if self.session_user_agent:
+                                    log.info(f"Storing successful User-Agent for download: {self.session_user_agent[:30]}...")
+
+                                elapsed = time.time() - start_time
+                                log.log(SUCCESS, f"Successfully found direct link after {total_attempts} total attempts ({elapsed:.2f}s)")
+                                log.info("Direct URL obtained, ready for download")
+
+                                # Circuits still in flight will exit at their next IO boundary
+                                self.link_found.set()
+                                for pending_future in pending:
+                                    pending_future.cancel()
+                                    pending_future.add_done_callback(self._close_ignored_result)
+
+                                self._cache_direct_link(url, result['direct_url'])
+                                return result['direct_url']
+                            else:
+                                failed_circuits += 1
+                                log.debug("Circuit %d failed to get direct link", circuit_id)
+                                if result and result.get('retry_after'):
+                                    retry_after = min(retry_after or result['retry_after'], result['retry_after'])
+                                    if result['retry_after'] > self.max_rate_limit_wait:
+                                        blocked_circuits += 1
+                        except Exception as exc:
+                            log.exception(f"Circuit {circuit_id} generated an exception: {exc}")
                             failed_circuits += 1
-                            print(f"[FICHIER][DEBUG] Circuit {circuit_id} failed to get direct link")
-                    except Exception as exc:
-                        print(f"[FICHIER][ERROR] Circuit {circuit_id} generated an exception: {exc}")
-                        traceback.print_exc()
-                        failed_circuits += 1
-
-            batch_elapsed = time.time() - batch_start_time
-            print(f"[FICHIER][INFO] Batch {batch+1} completed in {batch_elapsed:.2f}s with {batch_size} circuits")
-
-            # If we've reached the maximum number of attempts, break
-            if total_attempts >= self.max_attempts:
-                print(f"[FICHIER][WARNING] Reached maximum number of attempts ({self.max_attempts})")
-                break
 
-            # Implement exponential backoff between batches
-            if batch > 0:  # Don't increase delay after first batch
-                batch_delay = min(batch_delay * 1.5, max_batch_delay)  # Exponential backoff with cap
+                batch_elapsed = time.time() - batch_start_time
+                batch_attempts = len(started_at)
+                log.info(f"Batch {batch+1} completed in {batch_elapsed:.2f}s with {batch_attempts} circuits")
+
+                # Report the availability probe once it has finished
+                if service_probe is not None and service_probe.done():
+                    if not service_probe.result():
+                        log.warning("1fichier service may be unavailable, but will keep trying")
+                    service_probe = None
 
-            print(f"[FICHIER][WARNING] All circuits in batch {batch+1} failed, waiting {batch_delay:.1f}s before next batch...")
-            time.sleep(batch_delay)
+                # If we've reached the maximum number of attempts, break
+                if total_attempts >= self.max_attempts:
+                    log.warning(f"Reached maximum number of attempts ({self.max_attempts})")
+                    break
+
+                # A wait only applies to the exit node that got it and rate limited circuits are rotated,
+                # so only give up once every circuit of the batch was asked to wait too long
+                if batch_attempts and blocked_circuits == batch_attempts:
+                    log.error(f"1fichier asked every circuit to wait at least {retry_after}s before retrying, giving up")
+                    break
 
-        total_elapsed = time.time() - start_time
-        print(f"[FICHIER][ERROR] Failed after {total_attempts} attempts in {total_elapsed:.2f}s")
-        print(f"[FICHIER][INFO] Statistics: {failed_circuits} failed circuits, {successful_circuits} successful circuits")
-        error_msg = f"Failed to get direct download link after {total_attempts} attempts ({total_elapsed:.2f}s)"
-        print(f"[FICHIER][ERROR] {error_msg}")
-        raise Exception(error_msg)
+                if retry_after:
+                    # Deliberately capped: 1fichier never asks for less than a minute, but the next
+                    # batch goes through new exit nodes that the wait doesn't apply to
+                    batch_delay = min(retry_after, 15.0)
+                else:
+                    # Exponential backoff with jitter so parallel clients don't retry in lockstep
+                    batch_delay = min(0.5 * (2 ** batch), 15.0) * self.rng.uniform(0.5, 1.5)
+                log.warning(f"All circuits in batch {batch+1} failed, waiting {batch_delay:.1f}s before next batch...")
+                time.sleep(batch_delay)
+
+            total_elapsed = time.time() - start_time
+            log.error(f"Failed after {total_attempts} attempts in {total_elapsed:.2f}s")
+            log.info(f"Statistics: {failed_circuits} failed circuits")
+            error_msg = f"Failed to get direct download link after {total_attempts} attempts ({total_elapsed:.2f}s)"
+            log.error(error_msg)
+            raise Exception(error_msg)
+        finally:
+            self.lookup_running = False
+            self._release_idle_circuits()
 
     def start_download(self, url, save_path, header=None, out=None):
         """Start downloading a file from 1fichier"""
         self.current_url = url
         self.save_path = save_path
         self.session_user_agent = None  # Initialize user agent from successful circuit
+        self.out = out
+        self.tor_download_status = None
+        # Stop a download through Tor left running by a previous start
+        self.tor_download_stop.set()
 
         try:
             start_time = time.time()
-            print(f"[FICHIER][INFO] Starting 1fichier download process for URL: {url}")
-            print(f"[FICHIER][INFO] Save path: {save_path}")
+            log.info(f"Starting 1fichier download process for URL: {url}")
+            log.info(f"Save path: {save_path}")
 
             # Get the direct download link with parallel circuits
-            print(f"[FICHIER][INFO] Attempting to get direct download link via Tor circuits")
+            log.info("Attempting to get direct download link via Tor circuits")
             direct_url = self._get_direct_link(url)
             self.direct_url = direct_url
 
             elapsed = time.time() - start_time
-            print(f"[FICHIER][SUCCESS] Successfully obtained direct link in {elapsed:.2f} seconds")
+            log.log(SUCCESS, f"Successfully obtained direct link in {elapsed:.2f} seconds")
 
             # Use the HttpDownloader to download the file
             if out is None and self.filename:
                 out = self.filename
-                print(f"[FICHIER][INFO] Using filename from page: {out}")
+                log.info(f"Using filename from page: {out}")
             elif out is None:
                 out = "download"
-                print(f"[FICHIER][WARNING] No filename detected, using default: {out}")
+                log.warning(f"No filename detected, using default: {out}")
             else:
-                print(f"[FICHIER][INFO] Using provided filename: {out}")
+                log.info(f"Using provided filename: {out}")
 
             # Create custom header for the download
             # Use the User-Agent from the successful circuit if available
             if self.session_user_agent:
-                print(f"[FICHIER][INFO] Using User-Agent from successful Tor circuit for download")
+                log.info("Using User-Agent from successful Tor circuit for download")
                 custom_header = f"User-Agent: {self.session_user_agent}"
             else:
                 random_ua = self._get_random_user_agent()
-                print(f"[FICHIER][INFO] Using random User-Agent for download: {random_ua[:30]}...")
+                log.info(f"Using random User-Agent for download: {random_ua[:30]}...")
                 custom_header = f"User-Agent: {random_ua}"
 
             if header:
-                print(f"[FICHIER][INFO] Adding additional headers to request")
+                log.info("Adding additional headers to request")
                 custom_header += f"\n{header}"
 
+            self.out = out
+
             # Start the actual download using HttpDownloader
-            print(f"[FICHIER][INFO] Starting actual download with aria2 to {save_path}/{out}")
+            log.info(f"Starting actual download with aria2 to {save_path}/{out}")
             download_result = self.http_downloader.start_download(direct_url, save_path, custom_header, out)
-            print(f"[FICHIER][INFO] Download initiated with aria2c, GID: {download_result.get('gid', 'unknown')}")
+            log.info(f"Download initiated with aria2c, GID: {download_result.get('gid', 'unknown')}")
 
             return {
                 "status": "downloading",
@@ -379,8 +834,7 @@ class FichierDownloader:
 
         except Exception as e:
             error_message = str(e)
-            print(f"[FICHIER][ERROR] Error in 1fichier download process: {error_message}")
-            traceback.print_exc()
+            log.exception(f"Error in 1fichier download process: {error_message}")
             return {
                 "status": "error",
                 "message": f"Failed to start download: {error_message}",
@@ -389,34 +843,136 @@ class FichierDownloader:
 
     def pause_download(self):
         """Pause the current download"""
-        print(f"[FICHIER][INFO] Pausing download for file: {self.filename}")
+        log.info(f"Pausing download for file: {self.filename}")
+        self.tor_download_stop.set()
         result = self.http_downloader.pause_download()
         if result.get('status') == 'paused':
-            print(f"[FICHIER][INFO] Successfully paused download")
+            log.info("Successfully paused download")
         else:
-            print(f"[FICHIER][WARNING] Failed to pause download: {result.get('message', 'Unknown error')}")
+            log.warning(f"Failed to pause download: {result.get('message', 'Unknown error')}")
         return result
 
     def cancel_download(self):
         """Cancel the current download"""
-        print(f"[FICHIER][INFO] Cancelling download for file: {self.filename}")
+        log.info(f"Cancelling download for file: {self.filename}")
+        self.tor_download_stop.set()
+        # Release the circuit threads and every Tor circuit, including the one kept for the download
+        self.close()
         result = self.http_downloader.cancel_download()
         if result.get('status') == 'cancelled':
-            print(f"[FICHIER][INFO] Successfully cancelled download")
+            log.info("Successfully cancelled download")
         else:
-            print(f"[FICHIER][WARNING] Failed to cancel download: {result.get('message', 'Unknown error')}")
+            log.warning(f"Failed to cancel download: {result.get('message', 'Unknown error')}")
         return result
 
+    def _start_tor_download(self):
+        """Start downloading the file in the background through the Tor circuit that obtained the direct link"""
+        # Each thread gets its own stop event, clearing a shared one could revive a previous
+        # thread that is still blocked reading a chunk
+        self.tor_download_stop.set()
+        stop = threading.Event()
+        self.tor_download_stop = stop
+        status = {
+            'folderName': self.out,
+            'fileSize': 0,
+            'progress': 0,
+            'downloadSpeed': 0,
+            'numPeers': 0,
+            'numSeeds': 0,
+            'status': 'active',
+            'bytesDownloaded': 0,
+        }
+        self.tor_download_status = status
+        threading.Thread(target=self._download_through_tor, args=(status, stop), name="fichier-tor-download", daemon=True).start()
+
+    def _download_through_tor(self, status, stop):
+        """Stream the direct link through the active Tor session into the save path, resuming a partial file"""
+        session = self.active_tor_session
+        file_path = os.path.join(self.save_path, self.out)
+        headers = {"User-Agent": self.session_user_agent or self._get_random_user_agent()}
+
+        try:
+            # A previous thread may still be writing its last chunk, wait for it to let go of the file
+            with self.tor_download_lock:
+                if stop.is_set():
+                    status['status'] = 'paused'
+                    return
+
+                resume_from = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+                if resume_from:
+                    headers["Range"] = f"bytes={resume_from}-"
+
+                with session.get(self.direct_url, headers=headers, stream=True, timeout=self.circuit_timeout) as response:
+                    # 416 means the partial file already holds the whole download
+                    if response.status_code != 416:
+                        response.raise_for_status()
+                        if response.status_code != 206:
+                            resume_from = 0  # The range was ignored, start over
+                        if resume_from:
+                            log.info(f"Resuming download through Tor from byte {resume_from}")
+                        self._write_tor_download(response, file_path, resume_from, status, stop)
+
+            if stop.is_set():
+                log.info(f"Tor download stopped for file: {self.out}")
+                status['status'] = 'paused'
+                return
+
+            status['progress'] = 1
+            status['downloadSpeed'] = 0
+            status['status'] = 'complete'
+            log.log(SUCCESS, f"Download through Tor completed for file: {self.out}")
+            # The circuit was only kept for this download
+            if self.active_tor_session is session:
+                self._set_active_tor_session(None, None)
+        except Exception as e:
+            log.exception(f"Error downloading through Tor: {str(e)}")
+            status['status'] = 'error'
+
+    def _write_tor_download(self, response, file_path, resume_from, status, stop):
+        """Write a download response to the file chunk by chunk, reporting the progress in status"""
+        status['bytesDownloaded'] = resume_from
+        status['fileSize'] = resume_from + int(response.headers.get('Content-Length', 0))
+        start_time = time.time()
+
+        with open(file_path, 'ab' if resume_from else 'wb') as file:
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                if stop.is_set():
+                    return
+
+                file.write(chunk)
+                status['bytesDownloaded'] += len(chunk)
+                status['downloadSpeed'] = (status['bytesDownloaded'] - resume_from) / max(time.time() - start_time, 1)
+                if status['fileSize']:
+                    status['progress'] = status['bytesDownloaded'] / status['fileSize']
+
+    def _aria2_http_status(self):
+        """Return the HTTP status that made the aria2 download fail, if it failed on one"""
+        status_match = _ARIA2_HTTP_STATUS_RE.search(self.http_downloader.get_error_message() or "")
+        return int(status_match.group(1)) if status_match else None
+
     def get_download_status(self):
         """Get the status of the current download"""
+        if self.tor_download_status is not None:
+            return self.tor_download_status
+
         status = self.http_downloader.get_download_status()
+        if status and status.get('status') == 'error' and self.active_tor_session is not None and self._aria2_http_status() in (403, 429):
+            # The direct link may only be valid for the Tor exit node that obtained it
+            log.warning("aria2 could not download the file, retrying through the Tor circuit that obtained the link")
+            self.http_downloader.cancel_download()
+            self._start_tor_download()
+            return self.tor_download_status
+
         if status.get('status') == 'error':
-            print(f"[FICHIER][ERROR] Download error: {status.get('message', 'Unknown error')}")
-        elif status.get('status') == 'completed':
-            print(f"[FICHIER][SUCCESS] Download completed for file: {self.filename}")
+            log.error(f"Download error: {status.get('message', 'Unknown error')}")
+        elif status.get('status') == 'complete':
+            log.log(SUCCESS, f"Download completed for file: {self.filename}")
+            # aria2 didn't need the Tor circuit, stop holding it open
+            if self.active_tor_circuit is not None:
+                self._set_active_tor_session(None, None)
         elif status.get('progress'):
             # Only log progress occasionally to avoid log spam
             progress = status.get('progress', 0)
             if int(progress) % 10 == 0:  # Log every 10% progress
-                print(f"[FICHIER][INFO] Download progress: {progress}% for file: {self.filename}")
+                log.info(f"Download progress: {progress}% for file: {self.filename}")
         return status
@@ -28,6 +28,13 @@ class HttpDownloader:
             self.aria2.remove([self.download])
             self.download = None
 
+    def get_error_message(self):
+        if self.download == None:
+            return None
+
+        download = self.aria2.get_download(self.download.gid)
+        return download.error_message
+
     def get_download_status(self):
         if self.download == None:
             return None